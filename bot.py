@@ -5,19 +5,28 @@
 # Dataset loaded from data.json (see structure note below).
 
 import os
-import json
+import asyncio
 import re
-import difflib
-from io import BytesIO
+import random
+import hashlib
+import tempfile
 from typing import Dict, Any, List, Tuple
-from contextlib import suppress
+from functools import lru_cache
 
+import orjson
+from cachetools import TTLCache
+from aiohttp import web
+from aiolimiter import AsyncLimiter
 from aiogram import Bot, Dispatcher, Router, F
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
 from aiogram.filters import Command
+from aiogram.methods import GetUpdates
 from aiogram.types import Message, FSInputFile
 from aiogram.fsm.state import State, StatesGroup
 from aiogram.fsm.context import FSMContext
 from gtts import gTTS
+from rapidfuzz import fuzz
 
 # -----------------------------
 # Config: read token safely
@@ -83,9 +92,9 @@ FALLBACK_DATA = {
 
 def load_data() -> Dict[str, List[Dict[str, Any]]]:
     if os.path.exists(DATA_FILE):
-        with open(DATA_FILE, "r", encoding="utf-8") as f:
+        with open(DATA_FILE, "rb") as f:
             try:
-                data = json.load(f)
+                data = orjson.loads(f.read())
                 # quick sanity check
                 if not all(k in data for k in ("beginner", "intermediate", "advanced")):
                     return FALLBACK_DATA
@@ -97,43 +106,87 @@ def load_data() -> Dict[str, List[Dict[str, Any]]]:
 DATA = load_data()
 LEVELS = ["beginner", "intermediate", "advanced"]
 
+# TTS cache folder (mp3 files keyed by blake2b of "lang|text")
+AUDIO_DIR = os.getenv("AUDIO_DIR", "audio_cache")
+os.makedirs(AUDIO_DIR, exist_ok=True)
+# seconds per gTTS request; gTTS waits forever by default
+TTS_TIMEOUT = 10
+
 # -----------------------------
 # Helpers
 # -----------------------------
 
+_AR_STRIP = re.compile(r"[^\u0600-\u06FF0-9\s]")
+_EN_STRIP = re.compile(r"[^a-z0-9\s\-]")
+# alef/yaa/taa marbuta in a single pass
+_AR_LETTERS = str.maketrans("إأآاىة", "اااايه")
+
+@lru_cache(maxsize=1024)
 def normalize_ar(s: str) -> str:
     s = s.strip().lower()
     # remove tashkeel and common punctuation
-    s = re.sub(r"[^\u0600-\u06FF0-9\s]", " ", s)
+    s = _AR_STRIP.sub(" ", s)
     # normalize alef/yaa/taa marbuta
-    s = re.sub("[إأآا]", "ا", s)
-    s = re.sub("ى", "ي", s)
-    s = re.sub("ة", "ه", s)
-    s = re.sub(r"\s+", " ", s).strip()
-    return s
+    s = s.translate(_AR_LETTERS)
+    return " ".join(s.split())
 
+@lru_cache(maxsize=1024)
 def normalize_en(s: str) -> str:
     s = s.strip().lower()
-    s = re.sub(r"[^a-z0-9\s\-]", " ", s)
-    s = re.sub(r"\s+", " ", s).strip()
-    return s
+    s = _EN_STRIP.sub(" ", s)
+    return " ".join(s.split())
 
-def fuzzy_equal(a: str, b: str, lang: str) -> Tuple[bool, float]:
-    if lang == "ar":
-        a, b = normalize_ar(a), normalize_ar(b)
-    else:
-        a, b = normalize_en(a), normalize_en(b)
-    if not a or not b:
+@lru_cache(maxsize=1024)
+def _ratio(a: str, b: str) -> float:
+    return fuzz.ratio(a, b) / 100.0
+
+def fuzzy_equal_prenorm(user: str, correct_norm: str, lang: str) -> Tuple[bool, float]:
+    # only the user's text is normalized here; the correct side comes pre-normalized (see prepare_data)
+    user = normalize_ar(user) if lang == "ar" else normalize_en(user)
+    if not user or not correct_norm:
         return False, 0.0
-    ratio = difflib.SequenceMatcher(None, a, b).ratio()
+    ratio = _ratio(user, correct_norm)
     return (ratio >= 0.85), ratio
 
-def tts_bytes(text: str, lang: str = "en") -> BytesIO:
-    tts = gTTS(text=text, lang=lang)
-    bio = BytesIO()
-    tts.write_to_fp(bio)
-    bio.seek(0)
-    return bio
+def tts_file(text: str, lang: str = "en") -> FSInputFile:
+    key = hashlib.blake2b(f"{lang}|{text}".encode("utf-8"), digest_size=16).hexdigest()
+    path = os.path.join(AUDIO_DIR, f"{key}.mp3")
+    if not os.path.exists(path):
+        # write to a temp file first so a half-written mp3 is never served
+        # unique per call: concurrent threads may miss on the same key
+        fd, tmp = tempfile.mkstemp(dir=AUDIO_DIR, suffix=".tmp")
+        os.close(fd)
+        try:
+            gTTS(text=text, lang=lang, timeout=TTS_TIMEOUT).save(tmp)
+            os.replace(tmp, path)
+        except Exception:
+            # gTTS opens the file before the request; don't leave it behind
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+    return FSInputFile(path)
+
+async def tts_file_async(text: str, lang: str = "en") -> FSInputFile:
+    # gTTS does blocking HTTP; keep it off the event loop
+    return await asyncio.to_thread(tts_file, text, lang)
+
+def prepare_data(data: Dict[str, List[Dict[str, Any]]]) -> None:
+    # normalize the answers once at startup instead of on every attempt;
+    # malformed entries are dropped rather than crashing the bot at boot
+    for level, items in data.items():
+        if not isinstance(items, list):
+            continue
+        valid = []
+        for item in items:
+            if not (isinstance(item, dict) and isinstance(item.get("en"), str)
+                    and isinstance(item.get("ar"), str)):
+                continue
+            item["en_norm"] = normalize_en(item["en"])
+            item["ar_norm"] = normalize_ar(item["ar"])
+            valid.append(item)
+        data[level] = valid
+
+prepare_data(DATA)
 
 def pick_item(level: str, idx: int) -> Dict[str, Any]:
     items = DATA.get(level, [])
@@ -142,6 +195,12 @@ def pick_item(level: str, idx: int) -> Dict[str, Any]:
     idx = idx % len(items)
     return items[idx]
 
+def next_index(level: str, idx: int) -> int:
+    # random jump of 1..n-1 positions: never repeats the current item
+    # and needs no list of candidates
+    n = len(DATA.get(level, []))
+    return idx + (random.randrange(1, n) if n > 1 else 1)
+
 # -----------------------------
 # FSM
 # -----------------------------
@@ -150,7 +209,8 @@ class Train(StatesGroup):
     waiting_answer = State()
 
 # Per-user session (in-memory; Render free dyno is ephemeral but ok)
-SESS: Dict[int, Dict[str, Any]] = {}
+# bounded: idle users are evicted after an hour
+SESS: TTLCache = TTLCache(maxsize=10000, ttl=3600)
 
 def default_session() -> Dict[str, Any]:
     return {
@@ -160,11 +220,33 @@ def default_session() -> Dict[str, Any]:
         "current": None,   # current QA item
     }
 
+def get_session(uid: int) -> Dict[str, Any]:
+    sess = SESS.get(uid) or default_session()
+    # re-insert so the TTL counts from the user's last activity
+    SESS[uid] = sess
+    return sess
+
+class RateLimitMiddleware(BaseRequestMiddleware):
+    def __init__(self, limiter: AsyncLimiter):
+        self.limiter = limiter
+
+    async def __call__(self, make_request, bot, method):
+        # long polling is not a sent message; don't let it eat the budget
+        if isinstance(method, GetUpdates):
+            return await make_request(bot, method)
+        async with self.limiter:
+            return await make_request(bot, method)
+
 # -----------------------------
 # Bot + Router
 # -----------------------------
 
-bot = Bot(token=TOKEN)
+# keep idle connections to api.telegram.org open longer between replies
+session = AiohttpSession()
+session._connector_init.update(keepalive_timeout=75)
+# client-side shaping under Telegram's ~30 msg/s global cap
+session.middleware(RateLimitMiddleware(AsyncLimiter(30, 1)))
+bot = Bot(token=TOKEN, session=session)
 dp = Dispatcher()
 rt = Router()
 dp.include_router(rt)
@@ -175,7 +257,7 @@ dp.include_router(rt)
 
 @rt.message(Command("start"))
 async def cmd_start(m: Message, state: FSMContext):
-    SESS[m.from_user.id] = SESS.get(m.from_user.id, default_session())
+    get_session(m.from_user.id)
     await state.clear()
     txt = (
         "أهلًا أبو راية 👋\n"
@@ -202,7 +284,7 @@ async def cmd_help(m: Message):
 
 @rt.message(Command("level"))
 async def cmd_level(m: Message):
-    sess = SESS.setdefault(m.from_user.id, default_session())
+    sess = get_session(m.from_user.id)
     parts = m.text.split(maxsplit=1)
     if len(parts) == 2 and parts[1].lower() in LEVELS:
         sess["level"] = parts[1].lower()
@@ -213,7 +295,7 @@ async def cmd_level(m: Message):
 
 @rt.message(Command("mode"))
 async def cmd_mode(m: Message):
-    sess = SESS.setdefault(m.from_user.id, default_session())
+    sess = get_session(m.from_user.id)
     parts = m.text.split(maxsplit=1)
     if len(parts) == 2 and parts[1].lower() in ("en2ar", "ar2en"):
         sess["mode"] = parts[1].lower()
@@ -223,7 +305,7 @@ async def cmd_mode(m: Message):
 
 @rt.message(Command("train"))
 async def cmd_train(m: Message, state: FSMContext):
-    sess = SESS.setdefault(m.from_user.id, default_session())
+    sess = get_session(m.from_user.id)
     item = pick_item(sess["level"], sess["index"])
     if not item:
         await m.answer("البيانات غير متاحة لهذا المستوى.")
@@ -242,30 +324,30 @@ async def cmd_train(m: Message, state: FSMContext):
 @rt.message(Command("next"))
 @rt.message(Command("skip"))
 async def cmd_next(m: Message, state: FSMContext):
-    sess = SESS.setdefault(m.from_user.id, default_session())
-    sess["index"] += 1
+    sess = get_session(m.from_user.id)
+    sess["index"] = next_index(sess["level"], sess["index"])
     await cmd_train(m, state)
 
 @rt.message(Command("hint"))
 async def cmd_hint(m: Message):
-    sess = SESS.setdefault(m.from_user.id, default_session())
+    sess = get_session(m.from_user.id)
     item = sess.get("current")
     if not item:
         await m.answer("ابدأ أولًا بـ /train")
         return
     if sess["mode"] == "en2ar":
         # hint from Arabic answer first 2–3 letters
-        ans = normalize_ar(item["ar"])
+        ans = item["ar_norm"]
         hint = ans[:3] + "..."
         await m.answer(f"تلميح (بالعربي): {hint}")
     else:
-        ans = normalize_en(item["en"])
+        ans = item["en_norm"]
         hint = ans.split(" ")[0][:3] + "..."
         await m.answer(f"Hint (EN): {hint}")
 
 @rt.message(Command("voice"))
 async def cmd_voice(m: Message):
-    sess = SESS.setdefault(m.from_user.id, default_session())
+    sess = get_session(m.from_user.id)
     item = sess.get("current")
     if not item:
         await m.answer("ابدأ أولًا بـ /train")
@@ -273,8 +355,7 @@ async def cmd_voice(m: Message):
     # speak according to mode (speak the prompt sentence)
     speak_text = item["en"] if sess["mode"] == "en2ar" else item["ar"]
     lang = "en" if sess["mode"] == "en2ar" else "ar"
-    mp3 = tts_bytes(speak_text, lang=lang)
-    await m.answer_audio(audio=mp3, title=f"TTS ({lang})", caption=speak_text)
+    await m.answer_audio(audio=await tts_file_async(speak_text, lang=lang), title=f"TTS ({lang})", caption=speak_text)
 
 # -----------------------------
 # Answer handler
@@ -282,7 +363,7 @@ async def cmd_voice(m: Message):
 
 @rt.message(Train.waiting_answer, F.text)
 async def handle_answer(m: Message, state: FSMContext):
-    sess = SESS.setdefault(m.from_user.id, default_session())
+    sess = get_session(m.from_user.id)
     item = sess.get("current")
     if not item:
         await m.answer("ابدأ أولًا بـ /train")
@@ -291,25 +372,25 @@ async def handle_answer(m: Message, state: FSMContext):
     user_text = m.text.strip()
     if sess["mode"] == "en2ar":
         correct = item["ar"]
-        ok, score = fuzzy_equal(user_text, correct, lang="ar")
+        ok, score = fuzzy_equal_prenorm(user_text, item["ar_norm"], lang="ar")
     else:
         correct = item["en"]
-        ok, score = fuzzy_equal(user_text, correct, lang="en")
+        ok, score = fuzzy_equal_prenorm(user_text, item["en_norm"], lang="en")
 
     if ok:
-        reply = "✅ صحيح! ممتاز."
-        with suppress(Exception):
-            # also send TTS of the correct answer (always EN audio for practice)
-            mp3 = tts_bytes(item["en"], lang="en")
-            await m.answer_audio(audio=mp3, title="Correct – Listen (EN)", caption=item["en"])
-        # show example sentence(s)
+        # one message per correct answer: the EN audio (always EN for practice)
+        # with the verdict and example sentence(s) as its caption
+        reply = f"✅ صحيح! ممتاز.\n🔊 {item['en']}"
         ex = item.get("examples") or []
         if ex:
             reply += "\n\nمثال:\n• " + "\n• ".join(ex[:2])
-        await m.answer(reply)
-        # next
-        sess["index"] += 1
-        await cmd_train(m, state)
+        reply += "\n\nالسؤال التالي بـ /next"
+        try:
+            mp3 = await tts_file_async(item["en"], "en")
+            await m.answer_audio(audio=mp3, title="Correct – Listen (EN)", caption=reply)
+        except Exception:
+            await m.answer(reply)
+        await state.clear()
     else:
         sim = int(score * 100)
         await m.answer(
@@ -327,24 +408,38 @@ async def idle(m: Message):
 # Run
 # -----------------------------
 
-if __name__ == "__main__":
-    # Long polling (works fine على Render Web Service)
-    import asyncio
-    async def main():
-        print("Bot is running...")
+async def health(request: web.Request) -> web.Response:
+    return web.Response(text="Bot is running fine!")
+
+async def start_health_server() -> web.AppRunner:
+    # tiny HTTP endpoint so Render sees an open port; shares the bot's event loop
+    app = web.Application()
+    app.router.add_get("/", health)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, "0.0.0.0", int(os.getenv("PORT", "10000"))).start()
+    return runner
+
+async def prewarm_tts() -> None:
+    # fill the audio cache for every dataset answer so replies are cache hits
+    try:
+        texts = {item["en"] for level in LEVELS for item in DATA.get(level, [])}
+        await asyncio.gather(*(tts_file_async(t, "en") for t in texts), return_exceptions=True)
+    except Exception as e:
+        # runs as a background task; make failures visible in the logs
+        print(f"TTS prewarm failed: {e!r}")
+
+async def main():
+    runner = await start_health_server()
+    # in the background: a stalled gTTS request must not delay polling
+    prewarm = asyncio.create_task(prewarm_tts())
+    print("Bot is running...")
+    try:
         await dp.start_polling(bot, allowed_updates=dp.resolve_used_update_types())
+    finally:
+        prewarm.cancel()
+        await runner.cleanup()
 
-    asyncio.run(main())
-# --- existing bot code above ---
 if __name__ == "__main__":
-    print("Bot is running...")
-
-# keep render happy
-from flask import Flask
-app = Flask(__name__)
-
-@app.route('/')
-def home():
-    return "Bot is running fine!"
-
-app.run(host="0.0.0.0", port=10000)
+    # Long polling (works fine على Render Web Service)
+    asyncio.run(main())